@@ -0,0 +1,54 @@
+#!/usr/bin/python2
+
+'''
+Scene item that draws the hazard clearance fan around the robot, colour-coded from red
+(hazard close by) to green (clear out to the full range)
+
+'''
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+from math import cos, sin
+
+class ClearanceFan(QGraphicsItem):
+    def __init__(self, safeRange=50.0, parent=None):
+        super(ClearanceFan, self).__init__(parent)
+        self._safeRange = float(safeRange)
+        self._lines = []
+        self._bounds = QRectF()
+        self.setZValue(5)
+
+    def setFan(self, headings, clearance, origin):
+        #Coordinates are in whatever space the field was built in - the owner sets the transform
+        self.prepareGeometryChange()
+        self._lines = []
+        if origin is None:
+            self._bounds = QRectF()
+            return
+
+        x, y = origin
+        path = QPainterPath(QPointF(x, y))
+        for heading, dist in zip(headings, clearance):
+            end = QPointF(x + cos(heading) * dist, y + sin(heading) * dist)
+            self._lines.append((QLineF(QPointF(x, y), end), self._color(dist)))
+            path.lineTo(end)
+        self._bounds = path.boundingRect().adjusted(-1, -1, 1, 1)
+        self.update()
+
+    def _color(self, dist):
+        frac = max(0.0, min(1.0, dist / self._safeRange))
+        color = QColor(int(255 * (1 - frac)), int(255 * frac), 0)
+        color.setAlpha(140)
+        return color
+
+    def boundingRect(self):
+        return self._bounds
+
+    def paint(self, qp, options, widget):
+        for line, color in self._lines:
+            pen = QPen(color)
+            pen.setCosmetic(True)
+            pen.setWidth(2)
+            qp.setPen(pen)
+            qp.drawLine(line)
@@ -0,0 +1,43 @@
+#!/usr/bin/python2
+
+'''
+Process-wide record of which plugin instance commands each rover
+
+Any number of ground-station views can watch a rover, but only one of them may turn the
+joystick into steering commands (and log the mission) for it, otherwise every open panel
+would send its own copy of each command. Ownership is keyed by the rover's namespace
+
+'''
+import threading
+
+class CommandOwner(object):
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instanceLock:
+            if cls._instance is None:
+                cls._instance = CommandOwner()
+            return cls._instance
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owners = dict()
+
+    def owner(self, namespace):
+        with self._lock:
+            return self._owners.get(namespace)
+
+    def claim(self, namespace, widget):
+        #Take over the rover; the previous owner is told to stand down
+        with self._lock:
+            previous = self._owners.get(namespace)
+            self._owners[namespace] = widget
+        if previous is not None and previous is not widget:
+            previous.setCommanding(False)
+
+    def release(self, namespace, widget):
+        with self._lock:
+            if self._owners.get(namespace) is widget:
+                del self._owners[namespace]
@@ -0,0 +1,148 @@
+#!/usr/bin/python2
+
+'''
+Contour lines over the DEM, extracted once per elevation grid off the GUI thread
+
+A single worker thread does the extraction. Requests land in a one-slot mailbox that the
+newest grid overwrites, so a burst of patches costs at most the extraction already running
+plus one more for the latest grid
+
+Isolines come from marching squares on the elevation grid itself, so they are interpolated
+between cell centres and stop where they meet the map edge rather than running along it;
+they are then simplified for a handful of zoom levels and baked into one QPainterPath per level of detail,
+so panning and zooming only switch which cached path is visible
+
+'''
+import threading
+import numpy as np
+import cv2
+from skimage import measure
+
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+#Simplification tolerance of each level of detail, in scene (displayed DEM) pixels
+LOD_EPSILONS = [0.5, 2.0, 8.0]
+
+def contour_levels(elevation, interval, maxLevels=256):
+    minZ = float(np.min(elevation))
+    maxZ = float(np.max(elevation))
+    if interval <= 0:
+        #Auto - about twenty lines over the relief
+        interval = max((maxZ - minZ) / 20.0, np.finfo(np.float64).eps)
+    levels = np.arange(np.ceil(minZ / interval) * interval, maxZ, interval)
+    if len(levels) > maxLevels:
+        levels = levels[::int(np.ceil(len(levels) / float(maxLevels)))]
+    return levels
+
+def extract_contours(elevation, interval, epsilons=LOD_EPSILONS):
+    paths = [QPainterPath() for eps in epsilons]
+    for level in contour_levels(elevation, interval):
+        #(row, col) vertices; a line that closes on itself repeats its first vertex
+        for contour in measure.find_contours(elevation, level):
+            closed = len(contour) > 3 and np.array_equal(contour[0], contour[-1])
+            if closed:
+                contour = contour[:-1]
+            points = np.ascontiguousarray(contour[:, ::-1], dtype=np.float32).reshape(-1, 1, 2)
+            for path, eps in zip(paths, epsilons):
+                poly = cv2.approxPolyDP(points, eps, closed).reshape(-1, 2)
+                if len(poly) < 2:
+                    continue
+                #Vertices are in cell-centre coordinates; shift onto the scene's pixel centres
+                path.addPolygon(QPolygonF([QPointF(x + 0.5, y + 0.5) for x, y in poly]))
+                if closed:
+                    path.closeSubpath()
+    return paths
+
+class ContourOverlay(QObject):
+    contours_ready = Signal(int, object)
+
+    def __init__(self, scene, interval=0.0, color=QColor(240, 64, 10)):
+        super(ContourOverlay, self).__init__()
+        self._scene = scene
+        self.interval = interval
+        self._generation = 0
+        self._pending = None
+        self._stopped = False
+        self._wake = threading.Condition()
+        self._worker = None
+        self._items = []
+        self._lod = 0
+
+        self._pen = QPen(color)
+        self._pen.setCosmetic(True)
+        self._pen.setWidthF(1.0)
+
+        self.contours_ready.connect(self._install)
+
+    def rebuild(self, elevation):
+        #Newer requests replace any still waiting, and results of older ones are discarded
+        with self._wake:
+            if self._stopped:
+                return
+            self._generation += 1
+            self._pending = (self._generation, elevation, self.interval)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='ContourOverlay')
+                self._worker.daemon = True
+                self._worker.start()
+            self._wake.notify()
+
+    def clear(self):
+        #Forget the current map: drop its lines and anything still being extracted for it
+        with self._wake:
+            self._generation += 1
+            self._pending = None
+        for item in self._items:
+            self._scene.removeItem(item)
+        self._items = []
+
+    def shutdown(self):
+        with self._wake:
+            self._stopped = True
+            self._pending = None
+            self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._pending is None and not self._stopped:
+                    self._wake.wait()
+                if self._stopped:
+                    return
+                generation, elevation, interval = self._pending
+                self._pending = None
+            self.contours_ready.emit(generation, extract_contours(elevation, interval))
+
+    def _install(self, generation, paths):
+        if generation != self._generation:
+            return
+        for item in self._items:
+            self._scene.removeItem(item)
+
+        self._items = []
+        for path in paths:
+            item = QGraphicsPathItem(path)
+            item.setPen(self._pen)
+            item.setZValue(2)
+            item.setVisible(False)
+            self._scene.addItem(item)
+            self._items.append(item)
+        self.setLod(self._lod)
+
+    def setLod(self, lod):
+        self._lod = lod
+        for idx, item in enumerate(self._items):
+            item.setVisible(idx == lod)
+
+    def setViewScale(self, scale):
+        #Pick the coarsest path whose tolerance is still under a screen pixel
+        lod = 0
+        for idx, eps in enumerate(LOD_EPSILONS):
+            if eps * scale <= 1.0:
+                lod = idx
+        self.setLod(lod)
+
+    def items(self):
+        return list(self._items)
@@ -0,0 +1,64 @@
+#!/usr/bin/python2
+
+'''
+Scene item that draws the DEM straight from the retained 16-bit display grid
+
+The grid keeps 16 bits of the elevation stretch; what reaches the screen goes through a
+65536-entry lookup table applied only to the exposed rectangle at paint time. Changing the
+contrast window just swaps the table, and a partial DEM update only invalidates its own
+rectangle, since there is no private pixel copy to rebuild
+
+'''
+import numpy as np
+
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+def window_lut(low, high):
+    #16-bit display value -> 8-bit screen gray, linear between low and high, clamped outside
+    span = max(float(high) - float(low), 1.0)
+    ramp = (np.arange(65536, dtype=np.float32) - low) * (255.0 / span)
+    return np.clip(ramp, 0, 255).astype(np.uint8)
+
+class DEMItem(QGraphicsItem):
+    def __init__(self, grid, parent=None):
+        super(DEMItem, self).__init__(parent)
+        self._grid = grid
+        self._window = (0, 65535)
+        self._lut = window_lut(*self._window)
+        #Needed so paint() gets the exposed rect rather than redrawing the whole map
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def grid(self):
+        return self._grid
+
+    def setGrid(self, grid):
+        self.prepareGeometryChange()
+        self._grid = grid
+        self.update()
+
+    def window(self):
+        return self._window
+
+    def lut(self):
+        return self._lut
+
+    def setWindow(self, low, high):
+        #Contrast only - the grid itself is untouched
+        self._window = (int(low), int(high))
+        self._lut = window_lut(low, high)
+        self.update()
+
+    def boundingRect(self):
+        return QRectF(0, 0, self._grid.shape[1], self._grid.shape[0])
+
+    def paint(self, qp, options, widget):
+        #Whole pixels only, so partial redraws line up exactly with the grid
+        rect = options.exposedRect.toAlignedRect().intersected(QRect(0, 0, self._grid.shape[1], self._grid.shape[0]))
+        if rect.isEmpty():
+            return
+
+        tile = np.ascontiguousarray(self._lut.take(self._grid[rect.top():rect.bottom()+1, rect.left():rect.right()+1]))
+        image = QImage(tile, tile.shape[1], tile.shape[0], tile.shape[1], QImage.Format_Grayscale8)
+        qp.drawImage(QRectF(rect), image)
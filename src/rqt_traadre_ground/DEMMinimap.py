@@ -0,0 +1,65 @@
+#!/usr/bin/python2
+
+'''
+Overview of the whole map next to the main DEMView
+
+It is just a second view onto the main view's scene, so the DEM image, robot, goal and
+overlays are drawn from the same items with no copies; on top it outlines what the main
+view is showing. Repaints are driven by its own timer so a busy scene can't flood it
+
+'''
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+class DEMMinimap(QGraphicsView):
+    def __init__(self, mainView, refreshHz=5, parent=None):
+        super(DEMMinimap, self).__init__(mainView.scene(), parent)
+        self._main = mainView
+        self._dirty = True
+
+        #We decide when to repaint, not the scene
+        self.setViewportUpdateMode(QGraphicsView.NoViewportUpdate)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setInteractive(False)
+        self.setMinimumSize(120, 120)
+
+        self.scene().changed.connect(self._markDirty)
+        self._main.viewport_changed.connect(self._markDirty)
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._refresh)
+        self._timer.start(int(1000 / refreshHz))
+
+    def _markDirty(self, *args):
+        self._dirty = True
+
+    def _refresh(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.fitInView(self._main.sceneRect(), Qt.KeepAspectRatio)
+        self.viewport().update()
+
+    def resizeEvent(self, evt=None):
+        self._dirty = True
+        self._refresh()
+
+    def drawForeground(self, qp, rect):
+        #Outline of the main view's visible area, in scene coordinates
+        visible = self._main.mapToScene(self._main.viewport().rect())
+        pen = QPen(QColor(68, 134, 252))
+        pen.setCosmetic(True)
+        pen.setWidth(2)
+        qp.setPen(pen)
+        qp.setBrush(Qt.NoBrush)
+        qp.drawPolygon(visible)
+
+    def mousePressEvent(self, e):
+        #Click (or drag) to move the main view there
+        self._main.centerOn(self.mapToScene(e.pos()))
+
+    def mouseMoveEvent(self, e):
+        if e.buttons() & Qt.LeftButton:
+            self._main.centerOn(self.mapToScene(e.pos()))
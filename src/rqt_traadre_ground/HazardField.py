@@ -0,0 +1,109 @@
+#!/usr/bin/python2
+
+'''
+Distance-to-hazard field built from the hazmap, plus a batched caster that sweeps a fan
+of candidate headings from a point in one shot so steering feedback is just a lookup
+
+'''
+import numpy as np
+import cv2
+from math import pi
+
+def distanceField(hazmap):
+    #Hazmap convention matches DEMView._updateHazmap: 0 is a hazard, anything else is clear
+    clear = (np.asarray(hazmap) != 0).astype(np.uint8)
+
+    #Distance (in hazmap pixels) from every clear cell to the nearest hazard cell
+    return cv2.distanceTransform(clear, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+class HazardField(object):
+    def __init__(self, field, numHeadings=72, maxRange=None):
+        #The field itself is read-only and may be shared between views; only the fan is ours
+        self.field = field
+        self.h = field.shape[0]
+        self.w = field.shape[1]
+
+        if maxRange is None:
+            maxRange = int(np.ceil(np.hypot(self.w, self.h)))
+        self.maxRange = maxRange
+
+        #Fixed fan of headings, same convention as the steer angle: scene direction is (cos, sin)
+        self.headings = np.linspace(-pi, pi, numHeadings, endpoint=False)
+        self._dirs = np.stack((np.cos(self.headings), np.sin(self.headings)), axis=1)
+        self._clearance = np.zeros(numHeadings)
+        self._origin = None
+
+    def clearanceAt(self, x, y):
+        col = int(x)
+        row = int(y)
+        if row < 0 or col < 0 or row >= self.h or col >= self.w:
+            return 0.0
+        return float(self.field[row, col])
+
+    def castFan(self, x, y, step=1.0):
+        #Sphere-trace every heading together: each iteration advances all rays by the free
+        #distance at their current tip, so the number of iterations is small and independent
+        #of how many headings are in the fan
+        n = len(self.headings)
+        dist = np.zeros(n)
+        active = np.ones(n, dtype=bool)
+
+        if self.clearanceAt(x, y) <= 0:
+            self._clearance = dist
+            self._origin = (x, y)
+            return dist
+
+        for _ in range(256):
+            if not active.any():
+                break
+            tipX = x + self._dirs[active, 0] * dist[active]
+            tipY = y + self._dirs[active, 1] * dist[active]
+
+            cols = np.floor(tipX).astype(np.int64)
+            rows = np.floor(tipY).astype(np.int64)
+            inside = (cols >= 0) & (rows >= 0) & (cols < self.w) & (rows < self.h)
+
+            free = np.zeros(len(cols))
+            free[inside] = self.field[rows[inside], cols[inside]]
+
+            #Rays that leave the map or touch a hazard (free < one step) are done. Back off half
+            #a cell since the field is sampled at cell corners rather than the exact tip
+            advance = np.where(inside & (free >= step), free - 0.5, 0.0)
+            idx = np.flatnonzero(active)
+            dist[idx] += advance
+            done = (advance == 0) | (dist[idx] >= self.maxRange)
+            active[idx[done]] = False
+
+        #Rays still marching when the budget runs out are grazing a wall in half-cell steps;
+        #finish them with a fixed one-step march so they report where they really stop
+        idx = np.flatnonzero(active)
+        if len(idx):
+            steps = np.arange(1, int(np.ceil(self.maxRange / step)) + 1) * step
+            reach = dist[idx, None] + steps[None, :]
+            cols = np.floor(x + self._dirs[idx, 0, None] * reach).astype(np.int64)
+            rows = np.floor(y + self._dirs[idx, 1, None] * reach).astype(np.int64)
+            inside = (cols >= 0) & (rows >= 0) & (cols < self.w) & (rows < self.h)
+
+            free = np.zeros(reach.shape)
+            free[inside] = self.field[rows[inside], cols[inside]]
+
+            #Every ray is blocked by the end of the march, since reach passes maxRange
+            blocked = ~inside | (free < step) | (reach >= self.maxRange)
+            first = np.argmax(blocked, axis=1)
+            dist[idx] = reach[np.arange(len(idx)), first]
+
+        np.minimum(dist, self.maxRange, out=dist)
+        self._clearance = dist
+        self._origin = (x, y)
+        return dist
+
+    def lookup(self, heading):
+        #Nearest precomputed heading in the fan - no ray walking per steer update
+        if self._origin is None:
+            return 0.0
+        n = len(self.headings)
+        idx = int(round((heading + pi) / (2 * pi) * n)) % n
+        return float(self._clearance[idx])
+
+    def fan(self):
+        return self.headings, self._clearance, self._origin
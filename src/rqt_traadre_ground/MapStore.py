@@ -0,0 +1,97 @@
+#!/usr/bin/python2
+
+'''
+Process-wide store for decoded map products (DEM, hazmap, derived fields) so that several
+plugin instances can share one decode and one copy of each array
+
+rqt loads every plugin instance into the same process, so a single shared store is enough;
+products are handed out as numpy arrays that every view wraps without copying, so callers
+must treat them as read-only
+
+'''
+import threading
+
+class _Entry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.stamp = None
+        self.products = None
+        self.patchStamp = None
+        self.patchResult = None
+
+class MapStore(object):
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instanceLock:
+            if cls._instance is None:
+                cls._instance = MapStore()
+            return cls._instance
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = dict()
+
+    def acquire(self, key):
+        #Register interest in a key so its products outlive any single view
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry()
+                self._entries[key] = entry
+            entry.refs += 1
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs <= 0:
+                del self._entries[key]
+
+    def products(self, key, stamp, decode):
+        #Return the products for this stamp, decoding at most once no matter how many views
+        #receive the same message - later callers block on the key until the first finishes.
+        #A key nobody holds (a callback that outlived its release) is decoded but not kept,
+        #since nothing would ever release it again
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return decode()
+
+        with entry.lock:
+            if entry.stamp != stamp or entry.products is None:
+                entry.products = decode()
+                entry.stamp = stamp
+            return entry.products
+
+    def patch(self, key, stamp, apply):
+        #Merge a partial update into the shared products in place, once per message; views
+        #that get the same message afterwards just get the first merge's result back
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        with entry.lock:
+            if entry.products is None:
+                return None
+            if entry.patchStamp != stamp:
+                entry.patchResult = apply(entry.products)
+                entry.patchStamp = stamp
+            return entry.patchResult
+
+    def peek(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry.products
+
+def messageStamp(msg):
+    #Identify a message well enough to tell whether another view already decoded it
+    return (msg.header.stamp.to_nsec(), msg.header.seq, msg.width, msg.height, len(msg.data))
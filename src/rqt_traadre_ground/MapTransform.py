@@ -0,0 +1,44 @@
+#!/usr/bin/python2
+
+'''
+Single world <-> scene transform for everything drawn over the DEM
+
+World coordinates are metres in the map frame; scene coordinates are pixels of the displayed
+(downsampled) DEM. Conversions take and return Nx2 numpy arrays so overlays with many
+points pay for one vectorized call instead of a per-point copy and divide
+
+'''
+import numpy as np
+
+from PyQt5.QtCore import *
+
+class MapTransform(object):
+    def __init__(self, resolution=1.0, origin=(0.0, 0.0), downsample=1):
+        self.downsample = downsample
+        self.setMetadata(resolution, origin)
+
+    def setMetadata(self, resolution, origin):
+        #resolution is metres per full-resolution DEM cell, origin is the world position of cell 0,0
+        self.resolution = float(resolution)
+        self.origin = np.array(origin[:2], dtype=np.float64)
+        self._metresPerScene = self.resolution * self.downsample
+
+    def worldToScene(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return (points - self.origin) / self._metresPerScene
+
+    def sceneToWorld(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return points * self._metresPerScene + self.origin
+
+    def worldToSceneLength(self, length):
+        return length / self._metresPerScene
+
+    def sceneToWorldLength(self, length):
+        return length * self._metresPerScene
+
+    def centerItem(self, item, scenePoint):
+        #Icons are positioned by their top-left corner; put their centre on the point instead
+        bounds = item.boundingRect()
+        item.setPos(QPointF(scenePoint[0] - bounds.width()/2, scenePoint[1] - bounds.height()/2))
+        item.setTransformOriginPoint(QPointF(bounds.width()/2, bounds.height()/2))
@@ -0,0 +1,66 @@
+#!/usr/bin/python2
+
+'''
+Memory accounting for the map view: scene items by type, image bytes per layer and numpy
+buffers, checked against configurable limits
+
+Everything here returns plain dicts of numbers so it can be logged, shown in the UI or
+asserted on without a running ROS graph
+
+'''
+import numpy as np
+
+from PyQt5.QtGui import *
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+MB = float(2**20)
+
+def pixmap_bytes(pixmap):
+    if pixmap is None or pixmap.isNull():
+        return 0
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+def array_bytes(array):
+    if isinstance(array, np.ndarray):
+        return array.nbytes
+    return 0
+
+def scene_items(scene):
+    counts = dict()
+    for item in scene.items():
+        name = type(item).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def pixmap_items(scene):
+    #By class rather than name - QArrow and friends are pixmap items too
+    return sum(1 for item in scene.items() if isinstance(item, QGraphicsPixmapItem))
+
+class MemoryLimits(object):
+    def __init__(self, maxItems=500, maxPixmapItems=4, maxMegabytes=1024.0, autoEvict=True):
+        self.maxItems = maxItems
+        self.maxPixmapItems = maxPixmapItems
+        self.maxMegabytes = maxMegabytes
+        self.autoEvict = autoEvict
+
+    def check(self, report):
+        #Human-readable list of every limit the report is over
+        problems = []
+        items = sum(report['items'].values())
+        if items > self.maxItems:
+            problems.append('%d scene items (limit %d)' % (items, self.maxItems))
+        pixmaps = report['pixmapItems']
+        if pixmaps > self.maxPixmapItems:
+            problems.append('%d pixmap items (limit %d)' % (pixmaps, self.maxPixmapItems))
+        if report['total'] / MB > self.maxMegabytes:
+            problems.append('%1.1f MB held (limit %1.1f MB)' % (report['total'] / MB, self.maxMegabytes))
+        return problems
+
+def summary(report):
+    lines = ['%s: %1.1f MB' % (name, size / MB) for name, size in sorted(report['layers'].items())]
+    lines += ['%s: %1.1f MB' % (name, size / MB) for name, size in sorted(report['arrays'].items())]
+    lines += ['%s: %d' % (name, count) for name, count in sorted(report['items'].items())]
+    lines.append('pixmap items: %d' % report['pixmapItems'])
+    lines.append('subscribers: %d' % report['subscribers'])
+    return '\n'.join(lines)
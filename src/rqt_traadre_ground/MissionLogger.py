@@ -0,0 +1,132 @@
+#!/usr/bin/python2
+
+'''
+Background mission logger for what the operator saw and commanded
+
+Callbacks only enqueue a row (never blocking - rows are counted and dropped if the queue is
+full); a writer thread drains the queue in batches into one CSV per record kind, rotating
+files once they pass a size limit
+
+If the log directory can't be created or a write fails, logging stops for the rest of the
+session with a single error; the writer keeps draining the queue so callers never block
+
+'''
+import os, csv
+import errno
+import time
+import threading
+import itertools
+import Queue
+
+import rospy
+
+COLUMNS = {'state': ['stamp', 'x', 'y', 'z', 'roll', 'pitch', 'yaw', 'fuel'],
+           'goal': ['stamp', 'id', 'x', 'y'],
+           'steer': ['stamp', 'steer', 'id', 'goal_x', 'goal_y']}
+
+class MissionLogger(threading.Thread):
+    _instances = itertools.count()
+
+    def __init__(self, logDir, maxBytes=64*2**20, batchSize=512, flushPeriod=1.0, maxQueue=100000):
+        super(MissionLogger, self).__init__(name='MissionLogger')
+        self.daemon = True
+
+        self.logDir = logDir
+        self.maxBytes = maxBytes
+        self.batchSize = batchSize
+        self.flushPeriod = flushPeriod
+        self.dropped = 0
+        self.failed = False
+
+        #One session prefix per plugin instance so parallel views don't share files
+        self._prefix = '%s_%d' % (time.strftime('%Y%m%d_%H%M%S'), next(MissionLogger._instances))
+        self._queue = Queue.Queue(maxQueue)
+        self._files = dict()
+        self._stop = object()
+        self._stopping = threading.Event()
+
+    def log(self, kind, row):
+        if self.failed or self._stopping.is_set():
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait((kind, row))
+        except Queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        #Never waits - the writer flushes whatever is queued on its own and then exits; join()
+        #(with a timeout) only where the caller can afford to wait, like plugin shutdown
+        self._stopping.set()
+        try:
+            #Just a wake-up so it doesn't sit out the flush period
+            self._queue.put_nowait(self._stop)
+        except Queue.Full:
+            pass
+
+    def _fail(self, e):
+        #Once is enough - the operator needs to know logging stopped, not every failed row
+        if not self.failed:
+            self.failed = True
+            rospy.logerr('Mission log to %s stopped: %s' % (self.logDir, e))
+
+    def run(self):
+        try:
+            os.makedirs(self.logDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(self.logDir):
+                self._fail(e)
+
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flushPeriod))
+                while len(batch) < self.batchSize:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            if self._stop in batch:
+                batch.remove(self._stop)
+
+            if not self.failed:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    self._fail(e)
+
+            #Nothing is added once stopping, so an empty queue means everything is on disk
+            if self._stopping.is_set() and self._queue.empty():
+                break
+
+        for f, writer, index in self._files.values():
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        self._files = dict()
+
+    def _write(self, batch):
+        rows = dict()
+        for kind, row in batch:
+            rows.setdefault(kind, []).append(row)
+
+        for kind, kindRows in rows.items():
+            f, writer, index = self._open(kind)
+            writer.writerows(kindRows)
+            f.flush()
+            if f.tell() > self.maxBytes:
+                f.close()
+                del self._files[kind]
+                self._open(kind, index + 1)
+
+    def _open(self, kind, index=0):
+        if kind in self._files:
+            return self._files[kind]
+
+        path = os.path.join(self.logDir, '%s_%s_%03d.csv' % (self._prefix, kind, index))
+        f = open(path, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS[kind])
+        self._files[kind] = (f, writer, index)
+        return self._files[kind]
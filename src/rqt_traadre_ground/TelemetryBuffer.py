@@ -0,0 +1,144 @@
+#!/usr/bin/python2
+
+'''
+Columnar mission-long telemetry store and Largest-Triangle-Three-Buckets downsampling
+
+Samples land in preallocated numpy columns that double when full, so appending at 100 Hz
+never reallocates per sample; plots ask for an LTTB reduction to their pixel width, which
+keeps peaks and troughs that plain decimation would skip
+
+Alongside the raw columns, append keeps a fixed number of buckets holding where each
+field's minimum and maximum are; when they fill up, neighbouring pairs merge and each bucket
+covers twice as many samples. A plot only runs LTTB over those extrema, so its cost depends
+on the bucket count and chart width, never on how long the mission has been running
+
+'''
+import threading
+import numpy as np
+
+def lttb(x, y, threshold):
+    #Indices of the points LTTB keeps; the Python loop is per bucket, not per sample
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    #threshold - 2 buckets over the interior points, first and last are always kept
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avgX = np.add.reduceat(x[:n-1], edges[:-1]) / counts
+    avgY = np.add.reduceat(y[:n-1], edges[:-1]) / counts
+
+    #Each bucket is judged against the average of the one after it (the last point for the end)
+    nextX = np.append(avgX[1:], x[n-1])
+    nextY = np.append(avgY[1:], y[n-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo = edges[i]
+        hi = edges[i+1]
+        ax = x[a]
+        ay = y[a]
+        area = np.abs((ax - nextX[i]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (nextY[i] - ay))
+        a = lo + int(np.argmax(area))
+        selected[i+1] = a
+    return selected
+
+class TelemetryBuffer(object):
+    def __init__(self, fields, capacity=2**16, buckets=2048):
+        self.fields = list(fields)
+        self._lock = threading.Lock()
+        self._t = np.empty(capacity)
+        self._cols = np.empty((len(self.fields), capacity))
+        self._n = 0
+
+        #Sample indices of each field's min and max per bucket; _span samples per bucket
+        self._maxBuckets = buckets - buckets % 2
+        self._minIdx = np.zeros((len(self.fields), self._maxBuckets), dtype=np.int64)
+        self._maxIdx = np.zeros((len(self.fields), self._maxBuckets), dtype=np.int64)
+        self._span = 1
+        self._nb = 0
+        self._fill = 0
+        self._rows = np.arange(len(self.fields))
+
+    def __len__(self):
+        return self._n
+
+    def append(self, t, values):
+        with self._lock:
+            if self._n == len(self._t):
+                self._grow()
+            self._t[self._n] = t
+            self._cols[:, self._n] = values
+            self._aggregate(self._n)
+            self._n += 1
+
+    def _aggregate(self, i):
+        if self._nb == 0 or self._fill == self._span:
+            if self._nb == self._maxBuckets:
+                self._mergeBuckets()
+            #Start a new bucket with this sample as both extremes
+            self._minIdx[:, self._nb] = i
+            self._maxIdx[:, self._nb] = i
+            self._nb += 1
+            self._fill = 1
+            return
+
+        b = self._nb - 1
+        value = self._cols[:, i]
+        lower = value < self._cols[self._rows, self._minIdx[:, b]]
+        higher = value > self._cols[self._rows, self._maxIdx[:, b]]
+        self._minIdx[lower, b] = i
+        self._maxIdx[higher, b] = i
+        self._fill += 1
+
+    def _mergeBuckets(self):
+        #Halve the bucket count by merging neighbours, keeping the more extreme of each pair
+        rows = self._rows[:, None, None]
+        pairs = self._minIdx.reshape(len(self.fields), -1, 2)
+        pick = np.argmin(self._cols[rows, pairs], axis=2)
+        merged = np.where(pick == 0, pairs[:, :, 0], pairs[:, :, 1])
+        self._minIdx[:, :merged.shape[1]] = merged
+
+        pairs = self._maxIdx.reshape(len(self.fields), -1, 2)
+        pick = np.argmax(self._cols[rows, pairs], axis=2)
+        merged = np.where(pick == 0, pairs[:, :, 0], pairs[:, :, 1])
+        self._maxIdx[:, :merged.shape[1]] = merged
+
+        self._nb //= 2
+        self._span *= 2
+
+    def _grow(self):
+        capacity = 2 * len(self._t)
+        t = np.empty(capacity)
+        t[:self._n] = self._t[:self._n]
+        cols = np.empty((len(self.fields), capacity))
+        cols[:, :self._n] = self._cols[:, :self._n]
+        #Swap in whole arrays so readers holding the old views still see valid data
+        self._t = t
+        self._cols = cols
+
+    def series(self, field):
+        #Views, not copies - samples before n are never rewritten
+        with self._lock:
+            n = self._n
+            return self._t[:n], self._cols[self.fields.index(field), :n]
+
+    def candidates(self, field):
+        #Indices of the bucket extremes, plus both ends, in time order
+        f = self.fields.index(field)
+        with self._lock:
+            n = self._n
+            if n == 0:
+                return np.arange(0)
+            idx = np.concatenate((self._minIdx[f, :self._nb], self._maxIdx[f, :self._nb], [0, n - 1]))
+        return np.unique(idx)
+
+    def downsampled(self, field, width):
+        t, y = self.series(field)
+        keep = self.candidates(field)
+        keep = keep[keep < len(t)]
+        idx = keep[lttb(t[keep], y[keep], width)]
+        return t[idx], y[idx]
@@ -0,0 +1,90 @@
+#!/usr/bin/python2
+
+'''
+Strip charts of the robot state over the whole mission, drawn from a TelemetryBuffer
+
+Each chart only ever draws about one point per pixel column (LTTB-reduced from the buffer's
+per-bucket extremes, so a refresh costs the same an hour into the mission as at the start) and
+the panel refreshes on its own timer, so the ROS callbacks just append samples
+
+'''
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+
+class StripChart(QWidget):
+    def __init__(self, buffer, field, color=Qt.darkGreen):
+        super(StripChart, self).__init__()
+        self._buffer = buffer
+        self._field = field
+        self._color = QColor(color)
+        self._polygon = QPolygonF()
+        self._range = None
+        self._cacheKey = None
+        self.setMinimumHeight(30)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+
+    def refresh(self):
+        #Nothing new and the same width - keep the last reduction
+        width = max(self.width(), 3)
+        key = (len(self._buffer), width, self.height())
+        if key == self._cacheKey:
+            return
+        self._cacheKey = key
+
+        t, y = self._buffer.downsampled(self._field, width)
+        if len(t) < 2:
+            self._polygon = QPolygonF()
+            self._range = None
+            self.update()
+            return
+
+        t0, t1 = t[0], t[-1]
+        y0, y1 = y.min(), y.max()
+        spanT = max(t1 - t0, 1e-9)
+        spanY = max(y1 - y0, 1e-9)
+        h = self.height() - 2
+
+        xs = (t - t0) * ((width - 1) / spanT)
+        ys = 1 + h - (y - y0) * (h / spanY)
+        self._polygon = QPolygonF([QPointF(px, py) for px, py in zip(xs, ys)])
+        self._range = (y0, y1)
+        self.update()
+
+    def resizeEvent(self, evt=None):
+        self.refresh()
+
+    def paintEvent(self, evt=None):
+        qp = QPainter(self)
+        qp.fillRect(self.rect(), Qt.white)
+        qp.setPen(QPen(self._color, 1))
+        qp.drawPolyline(self._polygon)
+
+        qp.setPen(Qt.black)
+        label = self._field
+        if self._range is not None:
+            label = '%s [%1.2f, %1.2f]' % (self._field, self._range[0], self._range[1])
+        qp.drawText(self.rect().adjusted(3, 0, 0, 0), Qt.AlignLeft | Qt.AlignTop, label)
+        qp.end()
+
+class TelemetryPanel(QWidget):
+    def __init__(self, buffer, refreshHz=2):
+        super(TelemetryPanel, self).__init__()
+        layout = QVBoxLayout()
+        layout.setSpacing(1)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.charts = []
+        for field in buffer.fields:
+            chart = StripChart(buffer, field)
+            layout.addWidget(chart)
+            self.charts.append(chart)
+        self.setLayout(layout)
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(int(1000 / refreshHz))
+
+    def refresh(self):
+        for chart in self.charts:
+            chart.refresh()
@@ -0,0 +1,102 @@
+#!/usr/bin/python2
+
+'''
+Tile-parallel processing for DEM-sized arrays
+
+Arrays are split into tiles (with an overlap halo for stages that look at neighbours) and
+the per-tile work runs on a pool of threads. The heavy lifting is numpy/OpenCV, which drop
+the GIL, so tiles really do run on separate cores while sharing the same input and output
+buffers; each tile writes its core straight into the preallocated result, so there is no
+stitching pass afterwards
+
+'''
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import cv2
+
+import HazardField
+
+class TileEngine(object):
+    _default = None
+    _defaultLock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        #One pool per process, shared by every view
+        with cls._defaultLock:
+            if cls._default is None:
+                cls._default = TileEngine()
+            return cls._default
+
+    def __init__(self, workers=None, tileSize=512):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.tileSize = tileSize
+        self._pool = ThreadPool(self.workers)
+
+    def tiles(self, shape, overlap=0):
+        #(core, padded) row/col bounds; the core tiles partition the array exactly
+        h, w = shape[:2]
+        for r0 in range(0, h, self.tileSize):
+            r1 = min(r0 + self.tileSize, h)
+            for c0 in range(0, w, self.tileSize):
+                c1 = min(c0 + self.tileSize, w)
+                padded = (max(r0 - overlap, 0), min(r1 + overlap, h),
+                          max(c0 - overlap, 0), min(c1 + overlap, w))
+                yield (r0, r1, c0, c1), padded
+
+    def map(self, func, shape, overlap=0):
+        return self._pool.map(lambda bounds: func(*bounds), list(self.tiles(shape, overlap)))
+
+    def resize(self, src, downsample):
+        #Each output tile only needs its own downsample x downsample block of input, so the
+        #tiles need no halo and match a whole-image resize
+        h = src.shape[0] // downsample
+        w = src.shape[1] // downsample
+        out = np.empty((h, w), dtype=src.dtype)
+
+        def work(core, padded):
+            r0, r1, c0, c1 = core
+            block = src[r0*downsample:r1*downsample, c0*downsample:c1*downsample]
+            out[r0:r1, c0:c1] = cv2.resize(block, (c1 - c0, r1 - r0), interpolation = cv2.INTER_LINEAR)
+
+        self.map(work, (h, w))
+        return out
+
+    def minmax(self, src):
+        def work(core, padded):
+            r0, r1, c0, c1 = core
+            tile = src[r0:r1, c0:c1]
+            return tile.min(), tile.max()
+
+        ranges = self.map(work, src.shape)
+        return min(lo for lo, hi in ranges), max(hi for lo, hi in ranges)
+
+    def normalize(self, src, minZ, maxZ, dtype=np.uint16):
+        #Linear stretch of [minZ, maxZ] onto the full range of an integer dtype
+        top = np.iinfo(dtype).max
+        scale = top / max(maxZ - minZ, np.finfo(np.float64).eps)
+        out = np.empty(src.shape, dtype=dtype)
+
+        def work(core, padded):
+            r0, r1, c0, c1 = core
+            out[r0:r1, c0:c1] = np.clip((src[r0:r1, c0:c1] - minZ) * scale, 0, top)
+
+        self.map(work, src.shape)
+        return out
+
+    def distanceField(self, hazmap, maxDistance=128):
+        #Any hazard within maxDistance of a core pixel lies inside its padded tile, so the
+        #field is exact up to maxDistance and clamped beyond it
+        out = np.empty(hazmap.shape, dtype=np.float32)
+
+        def work(core, padded):
+            r0, r1, c0, c1 = core
+            p0, p1, q0, q1 = padded
+            field = HazardField.distanceField(hazmap[p0:p1, q0:q1])
+            out[r0:r1, c0:c1] = np.minimum(field[r0-p0:r1-p0, c0-q0:c1-q0], maxDistance)
+
+        self.map(work, hazmap.shape, overlap=maxDistance)
+        return out
@@ -0,0 +1,267 @@
+#!/usr/bin/python2
+
+'''
+Per-topic transport profiles (queue depth, socket buffer, tcp_nodelay, drop-old vs keep-all)
+for every subscription the ground station makes, with received/dropped counters per topic
+
+Drops are counted from gaps in header.seq, since rospy discards overflowing messages
+silently; topics without a header only report what was received
+
+Profiles are per process, not per plugin instance: rospy shares one subscriber
+implementation (queue, socket buffer, Nagle setting) per topic across every Subscriber in
+the node, so all instances see the same profile and changing one re-subscribes every
+subscription on that topic, in every instance
+
+Operators configure them with ~transport/<topic>/{queue_size, buff_size, tcp_nodelay,
+keep_all} params, read once per process; a topic set that way ignores the values saved in
+the perspective, so the launch file always wins
+
+'''
+import threading
+import rospy
+
+class TransportProfile(object):
+    def __init__(self, queue_size=1, buff_size=65536, tcp_nodelay=False, keep_all=False):
+        self.queue_size = queue_size
+        self.buff_size = buff_size
+        self.tcp_nodelay = tcp_nodelay
+        self.keep_all = keep_all
+
+    def subscriberArgs(self):
+        #rospy treats queue_size=None as unbounded, otherwise the oldest message is dropped
+        return {'queue_size': None if self.keep_all else self.queue_size,
+                'buff_size': self.buff_size,
+                'tcp_nodelay': self.tcp_nodelay}
+
+    def copy(self):
+        return TransportProfile(self.queue_size, self.buff_size, self.tcp_nodelay, self.keep_all)
+
+    def __eq__(self, other):
+        return isinstance(other, TransportProfile) and vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+#Full DEMs are hundreds of MB, so give them a big socket buffer and only ever keep the newest;
+#patches are incremental and must all be merged, so never drop them;
+#pose and joystick are tiny and latency sensitive, so turn off Nagle for them
+DEFAULT_PROFILES = {'dem': TransportProfile(queue_size=1, buff_size=2**28),
+                    'hazmap': TransportProfile(queue_size=1, buff_size=2**26),
+                    'dem_patch': TransportProfile(queue_size=10, buff_size=2**24, keep_all=True),
+                    'state': TransportProfile(queue_size=10, tcp_nodelay=True),
+                    'joy': TransportProfile(queue_size=1, tcp_nodelay=True),
+                    'current_goal': TransportProfile(queue_size=10, keep_all=True)}
+
+class TopicStats(object):
+    def __init__(self):
+        self.received = 0
+        self.dropped = 0
+        self.lastSeq = None
+
+    def count(self, msg):
+        self.received += 1
+        header = getattr(msg, 'header', None)
+        if header is None:
+            return
+        #Publishers stamp seq consecutively - a jump means messages never reached us
+        if self.lastSeq is not None and header.seq > self.lastSeq + 1:
+            self.dropped += header.seq - self.lastSeq - 1
+        self.lastSeq = header.seq
+
+class _Subscription(object):
+    def __init__(self, manager, topic, msg_type, callback):
+        self._manager = manager
+        self.topic = topic
+        self._msg_type = msg_type
+        self._callback = callback
+        self._sub = None
+        self._resolved = None
+        self.stats = TopicStats()
+        self.subscribe()
+
+    def _cb(self, msg):
+        self.stats.count(msg)
+        self._callback(msg)
+
+    def name(self):
+        #The topic rospy actually shares an implementation for
+        return rospy.resolve_name(self._manager.resolve(self.topic))
+
+    def subscribe(self):
+        self.disconnect()
+        #A different publisher (another rover) numbers its messages independently, so the
+        #counters start over rather than reading the jump in seq as drops
+        name = self.name()
+        if name != self._resolved:
+            self.stats = TopicStats()
+            self._resolved = name
+        profile = _registry.profile(self.topic)
+        self._sub = rospy.Subscriber(self._manager.resolve(self.topic), self._msg_type, self._cb,
+                                     **profile.subscriberArgs())
+        _registry.add(self)
+
+    def disconnect(self):
+        if self._sub:
+            self._sub.unregister()
+            self._sub = None
+
+    def unregister(self):
+        self.disconnect()
+        _registry.remove(self)
+        self._manager._forget(self)
+
+class _Registry(object):
+    #Process-wide profiles and every live subscription, across all plugin instances
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = dict((topic, p.copy()) for topic, p in DEFAULT_PROFILES.items())
+        self._subs = []
+        self._paramsLoaded = False
+        self._pinned = set()
+
+    def loadParams(self):
+        #Not at import time - the node may not be initialised yet
+        with self._lock:
+            if self._paramsLoaded:
+                return
+            self._paramsLoaded = True
+
+        for topic, values in rospy.get_param('~transport', {}).items():
+            if not isinstance(values, dict):
+                rospy.logwarn('~transport/%s should be a dict of profile fields, ignoring' % topic)
+                continue
+            current = self.profile(topic)
+            p = TransportProfile(int(values.get('queue_size', current.queue_size)),
+                                 int(values.get('buff_size', current.buff_size)),
+                                 _toBool(values.get('tcp_nodelay', current.tcp_nodelay)),
+                                 _toBool(values.get('keep_all', current.keep_all)))
+            with self._lock:
+                self._pinned.add(topic)
+            self.setProfile(topic, p)
+
+    def pinned(self, topic):
+        with self._lock:
+            return topic in self._pinned
+
+    def profile(self, topic):
+        with self._lock:
+            return self._profiles.setdefault(topic, TransportProfile())
+
+    def profiles(self):
+        with self._lock:
+            return dict(self._profiles)
+
+    def add(self, sub):
+        with self._lock:
+            if sub not in self._subs:
+                self._subs.append(sub)
+
+    def remove(self, sub):
+        with self._lock:
+            if sub in self._subs:
+                self._subs.remove(sub)
+
+    def setProfile(self, topic, profile):
+        with self._lock:
+            if self._profiles.get(topic) == profile:
+                return
+            self._profiles[topic] = profile
+            subs = list(self._subs)
+
+        #Every Subscriber on the topic has to go before rospy drops the shared implementation;
+        #only then do the new queue/Nagle settings apply, and buff_size only on new connections
+        names = set(sub.name() for sub in subs if sub.topic == topic)
+        affected = [sub for sub in subs if sub.name() in names]
+        for sub in affected:
+            sub.disconnect()
+        for sub in affected:
+            sub.subscribe()
+
+_registry = _Registry()
+
+class TransportManager(object):
+    def __init__(self, profiles=None, namespace=''):
+        _registry.loadParams()
+        if profiles:
+            for topic, profile in profiles.items():
+                _registry.setProfile(topic, profile)
+        self._subs = []
+        #Rover namespace every topic of this instance lives under; profiles stay keyed by the
+        #bare topic name so one profile covers every rover
+        self.namespace = namespace
+
+    def resolve(self, topic):
+        if not self.namespace:
+            return topic
+        return rospy.names.ns_join(self.namespace, topic)
+
+    def setNamespace(self, namespace):
+        if namespace == self.namespace:
+            return
+        subs = list(self._subs)
+        for sub in subs:
+            sub.disconnect()
+        self.namespace = namespace
+        for sub in subs:
+            sub.subscribe()
+
+    def profile(self, topic):
+        return _registry.profile(topic)
+
+    def setProfile(self, topic, profile):
+        #Process-wide - re-subscribes this topic in every instance so the change takes effect
+        _registry.setProfile(topic, profile)
+
+    def stats(self):
+        #Several callbacks can share a topic (the widget and the map both want 'state'), so
+        #report the busiest subscription per topic rather than double counting
+        stats = dict()
+        for sub in list(self._subs):
+            received, dropped = stats.get(sub.topic, (0, 0))
+            stats[sub.topic] = (max(received, sub.stats.received), max(dropped, sub.stats.dropped))
+        return stats
+
+    def totalDropped(self):
+        return sum(dropped for received, dropped in self.stats().values())
+
+    def summary(self):
+        return '\n'.join('%s: %d received, %d dropped' % (topic, received, dropped)
+                         for topic, (received, dropped) in sorted(self.stats().items()))
+
+    def subscriberCount(self):
+        return len(self._subs)
+
+    def subscribe(self, topic, msg_type, callback):
+        sub = _Subscription(self, topic, msg_type, callback)
+        self._subs.append(sub)
+        return sub
+
+    def _forget(self, sub):
+        if sub in self._subs:
+            self._subs.remove(sub)
+
+    def save_settings(self, instance_settings):
+        for topic, p in _registry.profiles().items():
+            prefix = 'transport/%s/' % topic
+            instance_settings.set_value(prefix + 'queue_size', p.queue_size)
+            instance_settings.set_value(prefix + 'buff_size', p.buff_size)
+            instance_settings.set_value(prefix + 'tcp_nodelay', p.tcp_nodelay)
+            instance_settings.set_value(prefix + 'keep_all', p.keep_all)
+
+    def restore_settings(self, instance_settings):
+        for topic in list(_registry.profiles().keys()):
+            if _registry.pinned(topic):
+                continue
+            prefix = 'transport/%s/' % topic
+            current = self.profile(topic)
+            #QSettings may hand values back as strings, so coerce everything explicitly
+            p = TransportProfile(int(instance_settings.value(prefix + 'queue_size', current.queue_size)),
+                                 int(instance_settings.value(prefix + 'buff_size', current.buff_size)),
+                                 _toBool(instance_settings.value(prefix + 'tcp_nodelay', current.tcp_nodelay)),
+                                 _toBool(instance_settings.value(prefix + 'keep_all', current.keep_all)))
+            self.setProfile(topic, p)
+
+def _toBool(value):
+    if isinstance(value, basestring):
+        return value.lower() in ('true', '1', 'yes')
+    return bool(value)
@@ -31,7 +31,6 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import rospy
-import tf
 from tf.transformations import *
 
 import numpy as np
@@ -55,12 +54,83 @@ from QLabeledValue import *
 import RobotIcon
 import ObjectIcon
 import QArrow
-
-import os, csv
+import ClearanceFan
+from DEMItem import DEMItem
+from MapTransform import MapTransform
+from ContourOverlay import ContourOverlay
+from DEMMinimap import DEMMinimap
+import MemoryAccount
+from HazardField import HazardField
+from TileEngine import TileEngine
+from MapStore import MapStore, messageStamp
+from TransportProfiles import TransportManager
+from TelemetryBuffer import TelemetryBuffer
+from TelemetryPanel import TelemetryPanel
+from MissionLogger import MissionLogger
+from CommandOwner import CommandOwner
+
+import os
 import rospkg
-import struct
 import cv2
-import copy
+import re
+
+def decode_dem(msg, downsample):
+    #64-bit little-endian elevations, viewed in place rather than unpacked value by value
+    a = np.frombuffer(msg.data, dtype='<f8', count=msg.width*msg.height)
+
+    #Resize and stretch run tile-parallel across the ground station's cores
+    engine = TileEngine.default()
+    rawDEM = engine.resize(a.reshape((msg.height, msg.width)), downsample)
+
+    #Scale to a 16-bit display grid; contrast is applied later through a lookup table
+    minZ, maxZ = engine.minmax(rawDEM)
+    grayDEM = engine.normalize(rawDEM, minZ, maxZ, np.uint16)
+
+    return {'raw': rawDEM, 'gray16': grayDEM, 'minZ': minZ, 'maxZ': maxZ}
+
+def parse_roi(frame_id):
+    #Partial DEMs carry their full-resolution pixel offset in the frame id, e.g. 'map roi:512,768'
+    match = re.search(r'roi:(\d+),(\d+)', frame_id)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+def patch_aligned(msg, offset, downsample):
+    #Each grid cell is one downsample x downsample block of the full DEM, so only patches made
+    #of whole blocks land on whole cells
+    return (offset[0] % downsample == 0 and offset[1] % downsample == 0 and
+            msg.width % downsample == 0 and msg.height % downsample == 0)
+
+def merge_dem_patch(products, msg, offset, downsample):
+    #Resample the patch onto the retained grid and restretch it with the original min/max so
+    #the rest of the map keeps its shading; returns the dirty region in grid pixels. The patch
+    #must be aligned to the grid (see patch_aligned)
+    rawDEM = products['raw']
+    gray = products['gray16']
+    h, w = rawDEM.shape
+
+    x0 = offset[0] // downsample
+    y0 = offset[1] // downsample
+    pw = min(max(msg.width // downsample, 1), w - x0)
+    ph = min(max(msg.height // downsample, 1), h - y0)
+    if pw <= 0 or ph <= 0:
+        return None
+
+    a = np.frombuffer(msg.data, dtype='<f8', count=msg.width*msg.height)
+    patch = cv2.resize(a.reshape((msg.height, msg.width)), (max(msg.width // downsample, 1), max(msg.height // downsample, 1)),
+                       interpolation = cv2.INTER_LINEAR)[:ph, :pw]
+    rawDEM[y0:y0+ph, x0:x0+pw] = patch
+
+    minZ = products['minZ']
+    dynRange = max(products['maxZ'] - minZ, np.finfo(np.float64).eps)
+    gray[y0:y0+ph, x0:x0+pw] = np.clip((patch - minZ) * (65535 / dynRange), 0, 65535).astype(np.uint16)
+
+    return (x0, y0, pw, ph)
+
+def decode_hazmap(msg):
+    #Unlike the dem, the hazmap is pretty standard - gray8 image
+    hazmap = np.ascontiguousarray(CvBridge().imgmsg_to_cv2(msg, desired_encoding="passthrough"))
+    return {'hazmap': hazmap, 'field': TileEngine.default().distanceField(hazmap)}
 
 def accepted_topic(topic):
     msg_types = [OccupancyGrid, Path, PolygonStamped, PointStamped]
@@ -76,7 +146,7 @@ class TraadreGroundWidget(QWidget):
     goal_changed = Signal()
     steer_changed = Signal(float)
         
-    def __init__(self, map_topic='/map'):
+    def __init__(self, map_topic='dem', namespace=''):
         super(TraadreGroundWidget, self).__init__()
 
         self._layout = QVBoxLayout()
@@ -85,12 +155,21 @@ class TraadreGroundWidget(QWidget):
         self.setWindowTitle('TRAADRE Ground Station')
         
         self.map = map_topic
-        self._tf = tf.TransformListener()
+
+        #Every subscription goes through here so queue/buffer settings are per topic and saved,
+        #and all of this instance's topics live under its rover namespace
+        self._transport = TransportManager(namespace=namespace)
+
+        #Only the instance commanding a rover reads the joystick, publishes steering and logs
+        self._commanding = False
+        self._logger = None
+        self.joy_sub = None
+        self.steer_pub = None
 
         vNavLayout = QVBoxLayout()
  
      
-        self._map_view = DEMView(map_topic, tf = self._tf, parent = self)
+        self._map_view = DEMView(map_topic, transport = self._transport, parent = self)
         #self._wordBank = HRIWordBank(parent = self)
         self._doneButton = QPushButton('Done!')
 #        self._doneButton.clicked.connect(self._map_view.savePoses)
@@ -139,32 +218,149 @@ class TraadreGroundWidget(QWidget):
 
         self.fuelLabel = QLabeledValue('Fuel')
         fuelLayout.addWidget(self.fuelLabel)
+        self.clearanceLabel = QLabeledValue('Clearance')
+        fuelLayout.addWidget(self.clearanceLabel)
+        self.droppedLabel = QLabeledValue('Dropped')
+        fuelLayout.addWidget(self.droppedLabel)
+        self.memoryLabel = QLabeledValue('Memory (MB)')
+        fuelLayout.addWidget(self.memoryLabel)
         fuelGroup.setLayout(fuelLayout)
         #hNavLayout.addWidget(fuelGroup)
 
+        #Window/level over the elevation stretch - only swaps the DEM lookup table
+        contrastGroup = QGroupBox('Contrast')
+        contrastLayout = QFormLayout()
+        self.levelSlider = QSlider(Qt.Horizontal)
+        self.widthSlider = QSlider(Qt.Horizontal)
+        for slider, value in [(self.levelSlider, 500), (self.widthSlider, 1000)]:
+            slider.setRange(1, 1000)
+            slider.setValue(value)
+            slider.valueChanged.connect(self._updateContrast)
+        contrastLayout.addRow('Level', self.levelSlider)
+        contrastLayout.addRow('Window', self.widthSlider)
+        contrastGroup.setLayout(contrastLayout)
+
+        #Which rover this panel shows, and whether it is the one steering it
+        roverGroup = QGroupBox('Rover')
+        roverLayout = QFormLayout()
+        self.namespaceEdit = QLineEdit(namespace)
+        self.namespaceEdit.setPlaceholderText('(default)')
+        self.namespaceEdit.editingFinished.connect(self._namespaceEdited)
+        self.commandBox = QCheckBox('Steer with joystick')
+        self.commandBox.toggled.connect(self.setCommanding)
+        roverLayout.addRow('Namespace', self.namespaceEdit)
+        roverLayout.addRow(self.commandBox)
+        roverGroup.setLayout(roverLayout)
+
+        fuelGoalLayout.addWidget(roverGroup)
         fuelGoalLayout.addWidget(goalGroup)
         fuelGoalLayout.addWidget(fuelGroup)
+        fuelGoalLayout.addWidget(contrastGroup)
         hNavLayout.addLayout(fuelGoalLayout)
 
+        #Overview of the whole map - a second view on the same scene, so no extra image memory
+        overviewGroup = QGroupBox('Overview')
+        overviewLayout = QVBoxLayout()
+        self._minimap = DEMMinimap(self._map_view)
+        overviewLayout.addWidget(self._minimap)
+        overviewGroup.setLayout(overviewLayout)
+        hNavLayout.addWidget(overviewGroup)
+
+        #Whole-mission history of the state fields, sampled at the state rate
+        self._telemetry = TelemetryBuffer(['X', 'Y', 'Z', 'Roll', 'Pitch', 'Yaw', 'Fuel'])
+        telemetryGroup = QGroupBox('Telemetry')
+        telemetryLayout = QVBoxLayout()
+        self._telemetryPanel = TelemetryPanel(self._telemetry)
+        telemetryLayout.addWidget(self._telemetryPanel)
+        telemetryGroup.setLayout(telemetryLayout)
+        hNavLayout.addWidget(telemetryGroup, 1)
+
         vNavLayout.addLayout(hNavLayout)
         self._layout.addLayout(vNavLayout)
         #self._layout.addWidget(self._doneButton)
         self.setLayout(self._layout)
         
         self.robot_state_changed.connect(self._updateState)
-        self.odom_sub = rospy.Subscriber('state', RobotState, self.robot_state_cb)
+        self.odom_sub = self._transport.subscribe('state', RobotState, self.robot_state_cb)
         
         self.goal_changed.connect(self._updateGoal)
-        self.goal_sub = rospy.Subscriber('current_goal', NamedGoal, self.goal_cb)
+        self.goal_sub = self._transport.subscribe('current_goal', NamedGoal, self.goal_cb)
 
         #Route steer signals to both update funcs
         map(self.steer_changed.connect, [self._updateSteer, self._map_view._updateSteer])
-        self.steer_pub = rospy.Publisher('steer', Steering, queue_size=10, latch=True)
-        
-        self.joy_sub = rospy.Subscriber('joy', Joy, self.joy_cb)
-        self.goal_sub = rospy.Subscriber('current_goal', NamedGoal, self.goal_cb)
+        self._map_view.clearance_changed.connect(self.clearanceLabel.updateValue)
+        self._map_view.memory_changed.connect(self._updateMemory)
+
         self._goal = ('None', 0.0, 0.0)
         self.lastSteerMsg = None
+        self._titleSuffix = ''
+
+        #The first panel on a rover commands it; later ones only watch until told otherwise
+        self.setCommanding(CommandOwner.instance().owner(namespace) is None)
+        self._updateTitle()
+
+    def setCommanding(self, on):
+        owners = CommandOwner.instance()
+        if on:
+            owners.claim(self._transport.namespace, self)
+            if not self._commanding:
+                self._startCommand()
+        else:
+            owners.release(self._transport.namespace, self)
+            if self._commanding:
+                self._stopCommand()
+
+        self.commandBox.blockSignals(True)
+        self.commandBox.setChecked(self._commanding)
+        self.commandBox.blockSignals(False)
+
+    def _startCommand(self):
+        self._commanding = True
+        self.steer_pub = rospy.Publisher(self._transport.resolve('steer'), Steering, queue_size=10, latch=True)
+        self.joy_sub = self._transport.subscribe('joy', Joy, self.joy_cb)
+
+        #Record state, goals and steering without waiting on disk in any callback
+        if rospy.get_param('~mission_log', True):
+            logDir = rospy.get_param('~mission_log_dir', os.path.join(rospkg.get_ros_home(), 'traadre_ground'))
+            self._logger = MissionLogger(logDir)
+            self._logger.start()
+
+    def _stopCommand(self):
+        self._commanding = False
+        self.joy_sub.unregister()
+        self.steer_pub.unregister()
+        self.joy_sub = None
+        self.steer_pub = None
+        if self._logger:
+            self._logger.stop()
+            self._logger = None
+
+    def _namespaceEdited(self):
+        self.setNamespace(str(self.namespaceEdit.text()).strip())
+
+    def setNamespace(self, namespace):
+        if namespace == self._transport.namespace:
+            return
+        #Stand down on the old rover, then pick up the new one if nobody is steering it yet
+        self.setCommanding(False)
+        self._transport.setNamespace(namespace)
+        self._map_view.namespaceChanged()
+        self._goal = ('None', 0.0, 0.0)
+        self.setCommanding(CommandOwner.instance().owner(namespace) is None)
+
+        if self.namespaceEdit.text() != namespace:
+            self.namespaceEdit.setText(namespace)
+        self._updateTitle()
+
+    def setTitleSuffix(self, suffix):
+        self._titleSuffix = suffix
+        self._updateTitle()
+
+    def _updateTitle(self):
+        title = 'TRAADRE Ground Station'
+        if self._transport.namespace:
+            title += ' - ' + self._transport.namespace
+        self.setWindowTitle(title + self._titleSuffix)
         
     def _updateState(self):
         for idx, val in enumerate(self._robotState):
@@ -172,17 +368,33 @@ class TraadreGroundWidget(QWidget):
 
         self.fuelLabel.updateValue(self._robotFuel)
 
+        self.droppedLabel.updateValue(self._transport.totalDropped())
+        self.droppedLabel.setToolTip(self._transport.summary())
+
         #Ping unity with a steer if enabled
         '''
         if not self.lastSteerMsg is None:
             self.steer_pub.publish(self.lastSteerMsg)
         '''
         
+    def _updateContrast(self, value=None):
+        self._map_view.setContrast(self.levelSlider.value() / 1000.0, self.widthSlider.value() / 1000.0)
+        low, high = self._map_view.windowElevation()
+        self.levelSlider.setToolTip('%1.2f - %1.2f m' % (low, high))
+        self.widthSlider.setToolTip('%1.2f - %1.2f m' % (low, high))
+
+    def _updateMemory(self, report):
+        self.memoryLabel.updateValue(report['total'] / MemoryAccount.MB)
+        self.memoryLabel.setToolTip(MemoryAccount.summary(report))
+
     def _updateGoal(self):
         for idx, val in enumerate(self._goal):
             self.goalLabels[idx].updateValue(val)
 
     def _updateSteer(self, steer):
+        if self.steer_pub is None:
+            return
+
         steerMsg = Steering()
         steerMsg.header.stamp = rospy.Time.now()
         steerMsg.steer= steer  * 180 / math.pi
@@ -193,6 +405,9 @@ class TraadreGroundWidget(QWidget):
         self.lastSteerMsg = steerMsg
         
         self.steer_pub.publish(steerMsg)
+        if self._logger:
+            self._logger.log('steer', [steerMsg.header.stamp.to_sec(), steerMsg.steer,
+                                       steerMsg.id, steerMsg.goal.x, steerMsg.goal.y])
         
         #print 'Updating main widgets to ', steer
     
@@ -221,6 +436,10 @@ class TraadreGroundWidget(QWidget):
         self._robotState = [worldX, worldY, worldZ, worldRoll, worldPitch, worldYaw]
         #print 'Robot State:', self._robotState
         self._robotFuel = msg.fuel
+        stamp = rospy.get_time()
+        self._telemetry.append(stamp, self._robotState + [self._robotFuel])
+        if self._logger:
+            self._logger.log('state', [stamp] + self._robotState + [self._robotFuel])
 
         self.robot_state_changed.emit()
         
@@ -233,35 +452,78 @@ class TraadreGroundWidget(QWidget):
         print 'Got Goal at: ' + str(worldX) + ',' + str(worldY)
 
         self._goal = [msg.id, worldX, worldY]
+        if self._logger:
+            self._logger.log('goal', [rospy.get_time()] + self._goal)
         self.goal_changed.emit()
         
+    def shutdown(self):
+        #The plugin is going away, so give the log a moment to reach disk - but only a moment
+        logger = self._logger
+        self.setCommanding(False)
+        if logger:
+            logger.join(2.0)
+        for sub in [self.odom_sub, self.goal_sub]:
+            sub.unregister()
+        self._map_view.shutdown()
+
     def save_settings(self, plugin_settings, instance_settings):
+        instance_settings.set_value('namespace', self._transport.namespace)
+        instance_settings.set_value('command_enabled', self._commanding)
+        self._transport.save_settings(instance_settings)
         self._map_view.save_settings(plugin_settings, instance_settings)
 
     def restore_settings(self, plugin_settings, instance_settings):
+        self.setNamespace(str(instance_settings.value('namespace', self._transport.namespace)))
+        self._transport.restore_settings(instance_settings)
         self._map_view.restore_settings(plugin_settings, instance_settings)
+
+        command = instance_settings.value('command_enabled', self._commanding)
+        if isinstance(command, basestring):
+            command = command.lower() in ('true', '1', 'yes')
+        self.setCommanding(bool(command))
+
+        #Put the sliders where the restored window is, without bouncing it back through them
+        level, width = self._map_view.contrast()
+        for slider, value in [(self.levelSlider, level), (self.widthSlider, width)]:
+            slider.blockSignals(True)
+            slider.setValue(int(round(value * 1000)))
+            slider.blockSignals(False)
         
 class DEMView(QGraphicsView):
     dem_changed = Signal()
     robot_odom_changed = Signal()
     goal_changed = Signal()
     hazmap_changed = Signal()
+    clearance_changed = Signal(float)
+    dem_patched = Signal(int, int, int, int)
+    viewport_changed = Signal()
+    memory_changed = Signal(object)
     
-    def __init__(self, dem_topic='dem',
-                 tf=None, parent=None):
+    def __init__(self, dem_topic='dem', transport=None, parent=None):
         super(DEMView, self).__init__()
         self._parent = parent
+        self._transport = transport if transport is not None else TransportManager()
+        self._demTopic = dem_topic
 
         self._goal_mode = True
 
         self.dem_changed.connect(self._update)
+        self.dem_patched.connect(self._updatePatch)
         self.hazmap_changed.connect(self._updateHazmap)
         self.demDownsample = 4
+
+        #One world <-> scene mapping for every overlay; resolution/origin come from the map
+        #metadata params since sensor_msgs/Image doesn't carry them
+        self.mapTransform = MapTransform(downsample=self.demDownsample)
         self._dem_item = None
         self._goalIcon = None
         self._robotIcon = None
         
         self.setDragMode(QGraphicsView.NoDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+
+        #Once the operator zooms, stop refitting the whole map on resize/new DEMs
+        self._zoomed = False
 
         self._addedItems = dict()
         self.w = 0
@@ -270,16 +532,94 @@ class DEMView(QGraphicsView):
         self._colors = [(125, 0, 125), (68, 134, 252), (236, 228, 46), (102, 224, 18), (242, 156, 6), (240, 64, 10), (196, 30, 250)]
         self._scene = QGraphicsScene()
 
+        #Isolines are extracted in the background once per elevation grid and cached as paths
+        self.grayDEM = None
+        self.rawDEM = None
+        self._dem = None
+        self._zRange = (0.0, 0.0)
+        #Contrast window in 16-bit display units - only ever changes the lookup table
+        self._window = (0, 65535)
+        self._contours = ContourOverlay(self._scene, rospy.get_param('~contour_interval', 0.0),
+                                        QColor(self._colors[5][0], self._colors[5][1], self._colors[5][2]))
+
+        #Decoded map products live in the process-wide store, shared with other instances;
+        #bumped on every rover change so maps still decoding for the old rover are discarded
+        self._store = MapStore.instance()
+        self._rover = 0
+        self._acquireStoreKeys()
+        self.goal_sub = None
+        self.hazmap_sub = None
        
-        self.dem_sub = rospy.Subscriber('dem', Image, self.dem_cb)
-        self.odom_sub = rospy.Subscriber('state', RobotState, self.robot_odom_cb)
+        self._warnedDemPatch = False
+        self.dem_sub = self._transport.subscribe(self._demTopic, Image, self.dem_cb)
+        self.dem_patch_sub = self._transport.subscribe('dem_patch', Image, self.dem_patch_cb)
+        self.odom_sub = self._transport.subscribe('state', RobotState, self.robot_odom_cb)
         
         self._robotLocation = [0,0,0,0,0,0]
+        self._robotScene = None
         self._goalLocations = [(0,0)]
         self.arrow = None
+
+        #Hazard clearance - the field is rebuilt once per hazmap, the fan only when the robot
+        #moves into another hazmap cell (it doesn't depend on heading)
+        self.hazField = None
+        self._fanCell = None
+        self.hazmap = None
+        self.hazmapItem = None
+        self._fanItem = None
+        self._clearanceItem = None
+        self._steer = None
         
         self.setScene(self._scene)
 
+        #Periodically account for what the view holds and act on the configured limits
+        self.memoryLimits = MemoryAccount.MemoryLimits(rospy.get_param('~memory_max_items', 500),
+                                                       rospy.get_param('~memory_max_pixmap_items', 4),
+                                                       rospy.get_param('~memory_max_mb', 1024.0),
+                                                       rospy.get_param('~memory_auto_evict', True))
+        self._memoryWarned = False
+        self._memoryTimer = QTimer(self)
+        self._memoryTimer.timeout.connect(self.checkMemory)
+        self._memoryTimer.start(5000)
+
+    def _acquireStoreKeys(self):
+        #Keyed by the fully resolved topic, so each rover's maps are decoded and held separately
+        self._demKey = (rospy.resolve_name(self._transport.resolve(self._demTopic)), self.demDownsample)
+        self._hazmapKey = (rospy.resolve_name(self._transport.resolve('hazmap')),)
+        self._store.acquire(self._demKey)
+        self._store.acquire(self._hazmapKey)
+
+    def namespaceChanged(self):
+        #The transport has already moved the subscriptions; follow it in the map store
+        self._rover += 1
+        if self._store:
+            self._store.release(self._demKey)
+            self._store.release(self._hazmapKey)
+            self._acquireStoreKeys()
+        self._clearRover()
+
+    def _clearRover(self):
+        #Nothing from the previous rover may stay on screen under the new one's name - the
+        #map, hazards, robot, goal and fan all come back as the new rover's messages arrive
+        for item in [self._dem_item, self.hazmapItem, self._goalIcon, self._robotIcon, self.arrow,
+                     self._fanItem, self._clearanceItem]:
+            if item is not None:
+                self._scene.removeItem(item)
+        self._dem_item = self.hazmapItem = self._goalIcon = self._robotIcon = self.arrow = None
+        self._fanItem = self._clearanceItem = None
+        self._contours.clear()
+
+        self.grayDEM = self.rawDEM = self._dem = None
+        self._zRange = (0.0, 0.0)
+        self.w = self.h = 0
+        self.hazmap = None
+        self.hazField = None
+        self._fanCell = None
+        self._robotLocation = [0,0,0,0,0,0]
+        self._robotScene = None
+        self._goalLocations = [(0,0)]
+        self._steer = None
+
     def goal_cb(self, msg):
          #Resolve the odometry to a screen coordinate for display
 
@@ -307,22 +647,13 @@ class DEMView(QGraphicsView):
         #Update the label's text:
         self._goalIcon.setText(str(self._goalID))
         
-        #Pick up the world coordinates
-        world = copy.deepcopy(self._goalLocations[0])
-
-        iconBounds = self._goalIcon.boundingRect()
-
-        world[0] /= self.demDownsample
-        world[1] /= self.demDownsample
-        
-        #Adjust the world coords so that the icon is centered on the goal
-        world[0] = world[0] - iconBounds.width()/2 
-        world[1] = world[1] - iconBounds.height()/2 #mirror the y coord
+        #Centre the icon on the goal's scene position
+        scene = self.mapTransform.worldToScene(self._goalLocations[0])[0]
+        self.mapTransform.centerItem(self._goalIcon, scene)
 
 #        world[1] = self.h - (world[1] + iconBounds.height()/2) #mirror the y coord
 #        print 'Ymax:', self.h
-        print 'Drawing goal ', self._goalID, ' at ', world
-        self._goalIcon.setPos(QPointF(world[0], world[1]))
+        print 'Drawing goal ', self._goalID, ' at ', scene
 
 
     def robot_odom_cb(self, msg):
@@ -353,28 +684,73 @@ class DEMView(QGraphicsView):
             self._scene.addItem(self.arrow)
 
             
-        iconBounds = self.arrow.boundingRect()
-        world = copy.deepcopy(self._robotLocation)
-
-        if world == [0,0,0,0,0,0]:
+        if self._robotScene is None:
             print 'No coords yet received..'
             return
         
-        #print 'Steering World coord:', world
-        world[0] /= self.demDownsample
-        world[1] /= self.demDownsample
-
-        #Adjust the world coords so that the icon is centered on the robot, rather than top-left
-        iconBounds = self.arrow.boundingRect() 
-        world[0] = world[0] - iconBounds.width()/2 
-        world[1] = world[1] - iconBounds.height()/2 #mirror the y coord
-
-        #print 'Steering screen coord:', world
-        self.arrow.setPos(QPointF(world[0], world[1]))
+        #Centre the arrow on the robot, rather than top-left, and spin it about its centre
+        self.mapTransform.centerItem(self.arrow, self._robotScene)
         self.arrow.setRotation(steer*180/math.pi + 90)
 
         #self._mirror(self.arrow)
-        self.arrow.setTransformOriginPoint(QPoint(iconBounds.width()/2, iconBounds.height()/2))
+
+        self._steer = steer
+        self._updateClearance()
+
+    def _hazScale(self):
+        #Scene units per hazmap pixel
+        return float(self.w) / self.hazField.w
+
+    def _updateFan(self):
+        if self.hazField is None or self._robotScene is None or self._dem_item is None:
+            return
+
+        #State arrives far faster than the robot crosses a cell, and casting near walls is
+        #the expensive case, so only recast from a new cell (from its centre, to stay stable)
+        scale = self._hazScale()
+        cell = (int(floor(self._robotScene[0] / scale)), int(floor(self._robotScene[1] / scale)))
+        if cell == self._fanCell:
+            return
+        self._fanCell = cell
+        self.hazField.castFan(cell[0] + 0.5, cell[1] + 0.5)
+
+        if self._fanItem is None:
+            self._fanItem = ClearanceFan.ClearanceFan(safeRange=self.hazField.w / 10.0)
+            self._scene.addItem(self._fanItem)
+
+        #Fan is drawn in hazmap pixels, so it shares the hazmap's scaling
+        trans = QTransform()
+        trans.scale(scale, scale)
+        self._fanItem.setTransform(trans)
+        self._fanItem.setFan(*self.hazField.fan())
+
+        self._updateClearance()
+
+    def _updateClearance(self):
+        if self.hazField is None or self._steer is None:
+            return
+        headings, clearance, origin = self.hazField.fan()
+        if origin is None:
+            return
+
+        scale = self._hazScale()
+        dist = self.hazField.lookup(self._steer)
+
+        if self._clearanceItem is None:
+            self._clearanceItem = QGraphicsSimpleTextItem()
+            self._clearanceItem.setFont(QFont("SansSerif", 10, QFont.Bold))
+            self._clearanceItem.setBrush(QBrush(QColor(self._colors[0][0], self._colors[0][1], self._colors[0][2])))
+            self._clearanceItem.setFlag(QGraphicsItem.ItemIgnoresTransformations)
+            self._clearanceItem.setZValue(10)
+            self._scene.addItem(self._clearanceItem)
+
+        #Report clearance in world units, label it at the point the steer ray hits a hazard
+        worldDist = self.mapTransform.sceneToWorldLength(dist * scale)
+        self._clearanceItem.setText('%1.1f' % worldDist)
+        self._clearanceItem.setPos(QPointF((origin[0] + math.cos(self._steer) * dist) * scale,
+                                           (origin[1] + math.sin(self._steer) * dist) * scale))
+
+        self.clearance_changed.emit(worldDist)
         
     def _updateRobot(self):
         #Redraw the robot locations
@@ -390,40 +766,20 @@ class DEMView(QGraphicsView):
 
 
             
-        #Pick up the world coordinates - copy so we can change in place
-        world = copy.deepcopy(self._robotLocation)
-        #print 'Raw robot loc: ', world[0], world[1]
+        #Centre the robot on its scene position, rather than top-left, and rotate about the
+        #centre so the caret turns in place
+        self._robotScene = self.mapTransform.worldToScene(self._robotLocation[:2])[0]
+        self.mapTransform.centerItem(self._robotIcon, self._robotScene)
         
-        iconBounds = self._robotIcon.boundingRect()
+        #print 'Rotating:', self._robotLocation[5]
+        self._robotIcon.setRotation(self._robotLocation[5]*180/math.pi + 90)
 
-        world[0] /= self.demDownsample
-        world[1] /= self.demDownsample
-        
-        #Adjust the world coords so that the icon is centered on the robot, rather than top-left
-        world[0] = world[0] - iconBounds.width()/2 
-        world[1] = world[1] - iconBounds.height()/2 #mirror the y coord
-
-        #print 'Drawing robot at ', world[0], world[1]
-        
-        self._robotIcon.setPos(QPointF(world[0], world[1]))
-        
-        #print 'Rotating:', world[5]
-        self._robotIcon.setRotation(world[5]*180/math.pi + 90)
-        
-        #Set the origin so that the caret rotates around its center(ish)
-        self._robotIcon.setTransformOriginPoint(QPoint(iconBounds.width()/2, iconBounds.height()/2))
-
-        #print 'Transform origin:', self._robotIcon.transformOriginPoint()
-        
         #self._mirror(self._robotIcon)
         #move the Steer icon as well
         if not self.arrow is None:
-            iconBounds = self.arrow.boundingRect()
-            steer_world = world
-            #steer_world[0] = world[0] - iconBounds.width()/2 
-            #steer_world[1] = world[1] - iconBounds.height()/2 #mirror the y coord
+            self.mapTransform.centerItem(self.arrow, self._robotScene)
 
-            self.arrow.setPos(QPointF(steer_world[0], steer_world[1]))
+        self._updateFan()
             
 
                           
@@ -447,114 +803,208 @@ class DEMView(QGraphicsView):
         return
     
     def hazmap_cb(self, msg):
-        #Unlike the dem, the hazmap is pretty standard - gray8 image
-        self.hazmap = CvBridge().imgmsg_to_cv2(msg, desired_encoding="passthrough")
+        #Decode and build the clearance field here, off the GUI thread, once per hazmap
+        #no matter how many views are showing it
+        store = self._store
+        if store is None:
+            return
+        rover = self._rover
+        products = store.products(self._hazmapKey, messageStamp(msg), lambda: decode_hazmap(msg))
+        if rover != self._rover:
+            return
+        self.hazmap = products['hazmap']
 
-        self.hazmapImage = QImage(self.hazmap, msg.width, msg.height, QImage.Format_Grayscale8)
+        self.hazField = HazardField(products['field'])
         self.hazmap_changed.emit()
 
     def _updateHazmap(self):
-        print 'Rendering hazmap'
-
-        hazTrans = QImage(self.hazmapImage.width(), self.hazmapImage.height(), QImage.Format_ARGB32)
-        #hazTrans.fill(Qt.transparent)
-
-        for row in range(0, self.hazmapImage.height()):
-            for col in range(0, self.hazmapImage.width()):
-                #Change the colormap to be clear for clear areas, red translucent for obstacles
-
-                pixColor = self.hazmap[row,col]
-
-                if pixColor == 0:
-                       #hazTrans.setPixelColor(col, row, QColor(255, 0, 0, 32))
-                    hazTrans.setPixel(col,row,0xffff0000)
-                else:
-                       #hazTrans.setPixelColor(col, row, QColor(0, 0, 0, 0))
-                    hazTrans.setPixel(col,row,0xdddddddd)
+        #Scaled onto the DEM, so it waits for one after a rover change (see _update)
+        if self._dem_item is None or self.hazmap is None:
+            return
 
+        print 'Rendering hazmap'
 
-        self.hazmapItem = self._scene.addPixmap(QPixmap.fromImage(hazTrans)) #.scaled(self.w*100,self.h*100))
-        self.hazmapItem.setPos(QPointF(0, 0))
+        #Change the colormap to be clear for clear areas, red translucent for obstacles - one
+        #vectorized pass into an ARGB32 buffer instead of setPixel per cell
+        hazColors = np.where(self.hazmap == 0, np.uint32(0xffff0000), np.uint32(0xdddddddd)).astype(np.uint32)
+        hazTrans = QImage(hazColors, hazColors.shape[1], hazColors.shape[0], hazColors.shape[1]*4, QImage.Format_ARGB32)
+        pixmap = QPixmap.fromImage(hazTrans)
+
+        #Reuse the one hazmap item rather than stacking a new pixmap per hazmap
+        if self.hazmapItem is None:
+            self.hazmapItem = self._scene.addPixmap(pixmap) #.scaled(self.w*100,self.h*100))
+            self.hazmapItem.setPos(QPointF(0, 0))
+        else:
+            self.hazmapItem.setPixmap(pixmap)
         trans = QTransform()
         #print 'Translating by:', bounds.width()
         
-        trans.scale(self.w/hazTrans.width(),self.h/hazTrans.height())
+        trans.scale(float(self.w)/hazTrans.width(), float(self.h)/hazTrans.height())
         #trans.translate(0, -bounds.height())
         self.hazmapItem.setTransform(trans)
+
+        #New hazards - recast the fan from the current pose
+        self._fanCell = None
+        self._updateFan()
         
         # Everything must be mirrored
         #self._mirror(self.hazmapItem)
         
+    def dem_patch_cb(self, msg):
+        offset = parse_roi(msg.header.frame_id)
+        if offset is None:
+            rospy.logwarn('DEM patch without an roi:x,y offset in frame_id, ignoring')
+            return
+        if not patch_aligned(msg, offset, self.demDownsample):
+            #Truncating onto the grid would shift and stretch it across the wrong cells
+            rospy.logwarn('DEM patch %dx%d at %d,%d is not aligned to the %d-cell display grid, ignoring'
+                          % (msg.width, msg.height, offset[0], offset[1], self.demDownsample))
+            return
+
+        #Merged into the shared grid once, whichever view sees the message first
+        store = self._store
+        if store is None:
+            return
+        rover = self._rover
+        dirty = store.patch(self._demKey, messageStamp(msg),
+                            lambda products: merge_dem_patch(products, msg, offset, self.demDownsample))
+        if dirty is None:
+            print 'Dropping DEM patch - no full DEM yet or patch lies outside it'
+            return
+        if rover == self._rover:
+            self.dem_patched.emit(*dirty)
+
+    def _updatePatch(self, x, y, w, h):
+        #The item draws straight from the grid, so only the patch rectangle needs repainting
+        if self._dem_item:
+            self._dem_item.update(QRectF(x, y, w, h))
+
+        #The elevation changed under the isolines - re-extract them in the background
+        if self.rawDEM is not None:
+            self._contours.rebuild(self.rawDEM)
+
     def dem_cb(self, msg):
-        #self.resolution = msg.info.resolution
-        self.w = msg.width
-        self.h = msg.height
+        store = self._store
+        if store is None:
+            return
+
+        #Image has no map info, so resolution/origin come from the same params the mapper uses
+        self.mapTransform.setMetadata(rospy.get_param('~dem_resolution', 1.0),
+                                   rospy.get_param('~dem_origin', [0.0, 0.0]))
+
+        #Patches belong on dem_patch, which keeps every message; this topic only keeps the newest,
+        #so merging patches from here would silently lose some of them in a burst
+        if parse_roi(msg.header.frame_id) is not None:
+            if not self._warnedDemPatch:
+                rospy.logwarn('DEM patch received on %s, ignoring - publish patches on %s instead'
+                              % (self.dem_sub.name(), self.dem_patch_sub.name()))
+                self._warnedDemPatch = True
+            return
 
         print 'Got DEM encoded as:', msg.encoding
         print 'message length:', len(msg.data), 'type:', type(msg.data)
         print 'width:', msg.width
         print 'height:', msg.height
-        
-        a = np.array(struct.unpack('<%dd' % (msg.width*msg.height), msg.data), dtype=np.float64, copy=False, order='C')
-
-   
-        rawDEM = a.reshape((self.h, self.w))
-        rawDEM = cv2.resize(rawDEM, (self.h//self.demDownsample, self.w//self.demDownsample), interpolation = cv2.INTER_LINEAR)
-        self.h = rawDEM.shape[0]
-        self.w = rawDEM.shape[1]
-        
-        '''
-        if self.w % 4:
-            e = np.zeros((self.h, 4 - self.w % 4), dtype=rawDEM.dtype, order='C')
-            rawDEM = np.append(rawDEM, e, axis=1)
-            self.h = rawDEM.shape[0]
-            self.w = rawDEM.shape[1]
-        ''' 
-
-        #Scale to a 8-bit grayscale image:
-        self.grayDEM = np.zeros(rawDEM.shape, dtype=np.uint8)
-        minZ = np.min(np.min(rawDEM))
-        maxZ = np.max(np.max(rawDEM))
-        dynRange = maxZ - minZ
 
-        print 'Max Z:', maxZ
-        print 'Min Z:', minZ
-        
-        for i in range(0, self.h):
-            for j in range(0, self.w):
-                self.grayDEM[i][j] = (rawDEM[i][j] - minZ) * 255/dynRange
-
-        #use OpenCV2 to interpolate the dem into something reasonably sized
-        print 'Grayscale conversion complete'
+        #Every view on this topic gets the same message - only the first one decodes it
+        rover = self._rover
+        products = store.products(self._demKey, messageStamp(msg),
+                                        lambda: decode_dem(msg, self.demDownsample))
+        if rover != self._rover:
+            return
 
-        #Needs to be a class variable so that at QImage built on top of this numpy array has
-        #a valid underlying buffer - local ars
-        #self.resizedDEM = cv2.resize(self.grayDEM, (500,500), interpolation = cv2.INTER_LINEAR)
+        print 'Max Z:', products['maxZ']
+        print 'Min Z:', products['minZ']
 
-        print 'Image resize complete'
-        
+        #The DEM item draws straight from this grid - it is shared read-only with the other views
+        self.grayDEM = products['gray16']
+        self.rawDEM = products['raw']
+        self._zRange = (products['minZ'], products['maxZ'])
         self.h = self.grayDEM.shape[0]
         self.w = self.grayDEM.shape[1]
-        image = QImage(self.grayDEM.reshape((self.h*self.w)), self.w, self.h, QImage.Format_Grayscale8)
 
-        #        for i in reversed(range(101)):
-        #            image.setColor(100 - i, qRgb(i* 2.55, i * 2.55, i * 2.55))
-        #        image.setColor(101, qRgb(255, 0, 0))  # not used indices
-        #        image.setColor(255, qRgb(200, 200, 200))  # color for unknown value -1
-
-        self._dem = image       
+        self._dem = self.grayDEM
         self.dem_changed.emit()
 
-    def close(self):
+    def _ownedItems(self):
+        #Everything the view deliberately keeps in the scene; anything else is a leak
+        owned = [self._dem_item, self.hazmapItem, self._goalIcon, self._robotIcon, self.arrow,
+                 self._fanItem, self._clearanceItem] + self._contours.items()
+        return set(item for item in owned if item is not None)
 
-        if self.dem_sub:
-            self.dem_sub.unregister()
-        if self.goal_sub:
-            self.goal_sub.unregister()
-        if self.pose_sub:
-            self.pose_sub.unregister()
-            
-        super().close()
+    def memory_report(self):
+        layers = {'hazmap': MemoryAccount.pixmap_bytes(self.hazmapItem.pixmap()) if self.hazmapItem else 0}
+        #The DEM layer is its 16-bit display grid plus the contrast lookup table it paints through
+        layers['dem'] = 0
+        if self._dem_item:
+            layers['dem'] = (MemoryAccount.array_bytes(self._dem_item.grid()) +
+                             MemoryAccount.array_bytes(self._dem_item.lut()))
+
+        #Pixmaps nobody owns any more - what leaked hazmaps would look like
+        leaked = 0
+        owned = self._ownedItems()
+        for item in self._scene.items():
+            if isinstance(item, QGraphicsPixmapItem) and item not in owned:
+                leaked += MemoryAccount.pixmap_bytes(item.pixmap())
+        layers['unowned'] = leaked
+
+        #The grids are shared through the map store, so these are counted once per view but
+        #held once per process
+        arrays = {'rawDEM': MemoryAccount.array_bytes(self.rawDEM),
+                  'hazmap': MemoryAccount.array_bytes(self.hazmap),
+                  'hazField': MemoryAccount.array_bytes(self.hazField.field) if self.hazField else 0}
+
+        return {'items': MemoryAccount.scene_items(self._scene),
+                'pixmapItems': MemoryAccount.pixmap_items(self._scene),
+                'layers': layers,
+                'arrays': arrays,
+                'subscribers': self._transport.subscriberCount(),
+                'total': sum(layers.values()) + sum(arrays.values())}
+
+    def evictUnowned(self):
+        owned = self._ownedItems()
+        evicted = 0
+        for item in self._scene.items():
+            #Only top-level strays; children go with their parent
+            if item.parentItem() is None and item not in owned:
+                self._scene.removeItem(item)
+                evicted += 1
+        return evicted
+
+    def checkMemory(self):
+        report = self.memory_report()
+        problems = self.memoryLimits.check(report)
+        if problems:
+            if self.memoryLimits.autoEvict:
+                evicted = self.evictUnowned()
+                if evicted:
+                    rospy.logwarn('DEMView evicted %d unowned scene items' % evicted)
+                    report = self.memory_report()
+            if not self._memoryWarned:
+                rospy.logwarn('DEMView memory over limits: ' + ', '.join(problems))
+                self._memoryWarned = True
+        else:
+            self._memoryWarned = False
+        self.memory_changed.emit(report)
+        return report
+
+    def shutdown(self):
+        self._memoryTimer.stop()
+        self._contours.shutdown()
+        for sub in [self.dem_sub, self.dem_patch_sub, self.odom_sub, self.goal_sub, self.hazmap_sub]:
+            if sub:
+                sub.unregister()
+        self.dem_sub = self.dem_patch_sub = self.odom_sub = self.goal_sub = self.hazmap_sub = None
+
+        #Drop our hold on the shared map products - the last view out frees them
+        if self._store:
+            self._store.release(self._demKey)
+            self._store.release(self._hazmapKey)
+            self._store = None
+
+    def close(self):
+        self.shutdown()
+        return super(DEMView, self).close()
         
     def dragMoveEvent(self, e):
         print('Scene got drag move event')
@@ -565,38 +1015,78 @@ class DEMView(QGraphicsView):
         bounds = self._scene.sceneRect()
         if bounds:
             self._scene.setSceneRect(-50, -50, self.w*scale+100, self.h*scale+100)
-            self.fitInView(self._scene.sceneRect(), Qt.KeepAspectRatio)
-            self.centerOn(self._dem_item)
+            if not self._zoomed and self._dem_item:
+                self.fitInView(self._scene.sceneRect(), Qt.KeepAspectRatio)
+                self.centerOn(self._dem_item)
+            self._viewChanged()
             self.show()
+
+    def wheelEvent(self, e):
+        #Zoom about the cursor; the minimap keeps the context
+        factor = 1.25 if e.angleDelta().y() > 0 else 0.8
+        self.scale(factor, factor)
+        self._zoomed = True
+        self._viewChanged()
+
+    def mouseDoubleClickEvent(self, e):
+        #Back to the whole map
+        self._zoomed = False
+        self.fitInView(self.sceneRect(), Qt.KeepAspectRatio)
+        self._viewChanged()
+
+    def scrollContentsBy(self, dx, dy):
+        super(DEMView, self).scrollContentsBy(dx, dy)
+        self.viewport_changed.emit()
+
+    def _viewChanged(self):
+        self._contours.setViewScale(self.transform().m11())
+        self.viewport_changed.emit()
  
     def _update(self):
         if self._dem_item:
-            self._scene.removeItem(self._dem_item)
-
-        pixmap = QPixmap.fromImage(self._dem)
-        self._dem_item = self._scene.addPixmap(pixmap) #.scaled(self.w*100,self.h*100))
-        self._dem_item.setPos(QPointF(0, 0))
-        # Everything must be mirrored
-        #self._mirror(self._dem_item)
-
-        # Add drag and drop functionality
-        self.add_dragdrop(self._dem_item)
+            self._dem_item.setGrid(self._dem)
+        else:
+            self._dem_item = DEMItem(self._dem)
+            self._dem_item.setWindow(*self._window)
+            self._scene.addItem(self._dem_item)
+            self._dem_item.setPos(QPointF(0, 0))
+            # Everything must be mirrored
+            #self._mirror(self._dem_item)
+
+            # Add drag and drop functionality
+            self.add_dragdrop(self._dem_item)
 
         #Resize map to fill window
         scale = 1
         self.setSceneRect(-50, -50, self.w*scale+100, self.h*scale+100)
-        self.fitInView(self._scene.sceneRect(), Qt.KeepAspectRatio)
-        self.centerOn(self._dem_item)
+        if not self._zoomed:
+            self.fitInView(self._scene.sceneRect(), Qt.KeepAspectRatio)
+            self.centerOn(self._dem_item)
+        self._viewChanged()
         self.show()
+
+        self._contours.rebuild(self.rawDEM)
         bounds = self._scene.sceneRect()
+
+        #A new DEM can change the hazmap's scale in the scene
+        self._fanCell = None
+        self._updateFan()
         #print 'Bounds:', bounds
-        #Allow the robot position to be drawn on the DEM 
-        self.robot_odom_changed.connect(self._updateRobot)
-        self.goal_changed.connect(self._updateGoal)
-        self.goal_sub = rospy.Subscriber('current_goal', NamedGoal, self.goal_cb)
 
-        #Overlay the hazmap now that the dem is loaded
-        self.hazmap_sub = rospy.Subscriber('hazmap', Image, self.hazmap_cb)
+        #Only the first DEM wires up the overlays - later ones would stack duplicate
+        #connections and subscriptions
+        if self.goal_sub is None:
+            #Allow the robot position to be drawn on the DEM 
+            self.robot_odom_changed.connect(self._updateRobot)
+            self.goal_changed.connect(self._updateGoal)
+            self.goal_sub = self._transport.subscribe('current_goal', NamedGoal, self.goal_cb)
+
+        if self.hazmap_sub is None:
+            #Overlay the hazmap now that the dem is loaded
+            self.hazmap_sub = self._transport.subscribe('hazmap', Image, self.hazmap_cb)
+        elif self.hazmapItem is None:
+            #A new rover's hazmap can beat its first DEM in
+            self._updateHazmap()
 
     def _mirror(self, item):
         #Get the width from the item's bounds...
@@ -614,11 +1104,40 @@ class DEMView(QGraphicsView):
         #bounds = item.sceneBoundingRect()
         #print 'Bounds:', bounds
 
+    def setContourInterval(self, interval):
+        if interval == self._contours.interval:
+            return
+        self._contours.interval = interval
+        if self.rawDEM is not None:
+            self._contours.rebuild(self.rawDEM)
+
+    def setContrast(self, level, width):
+        #level/width are fractions of the DEM's elevation range - the window centre and span
+        low = int(round((level - width / 2.0) * 65535))
+        high = int(round((level + width / 2.0) * 65535))
+        self._window = (low, max(high, low + 1))
+        if self._dem_item:
+            self._dem_item.setWindow(*self._window)
+
+    def contrast(self):
+        low, high = self._window
+        return (low + high) / 2.0 / 65535, (high - low) / 65535.0
+
+    def windowElevation(self):
+        #The current window in metres, for display
+        minZ, maxZ = self._zRange
+        low, high = self._window
+        return minZ + (maxZ - minZ) * low / 65535.0, minZ + (maxZ - minZ) * high / 65535.0
+
     def save_settings(self, plugin_settings, instance_settings):
-        # TODO add any settings to be saved
-        pass
+        instance_settings.set_value('contour_interval', self._contours.interval)
+        level, width = self.contrast()
+        instance_settings.set_value('contrast_level', level)
+        instance_settings.set_value('contrast_width', width)
 
     def restore_settings(self, plugin_settings, instance_settings):
-        # TODO add any settings to be restored
-        pass    
+        self.setContourInterval(float(instance_settings.value('contour_interval', self._contours.interval)))
+        level, width = self.contrast()
+        self.setContrast(float(instance_settings.value('contrast_level', level)),
+                         float(instance_settings.value('contrast_width', width)))
 
@@ -39,15 +39,16 @@ class TraadreGroundPlugin(Plugin):
         
         super(TraadreGroundPlugin, self).__init__(context)
         self.setObjectName('TraadreGroundPlugin')
-        if context.serial_number() > 1:
-            raise RuntimeError("Due to a limitation of tf_frames you may not run more than one instance of rqt_traadre_ground.")
         self._widget = TraadreGroundWidget()
         if context.serial_number() > 1:
-            self._widget.setWindowTitle(self._widget.windowTitle() + (' (%d)' % context.serial_number()))
+            self._widget.setTitleSuffix(' (%d)' % context.serial_number())
         context.add_widget(self._widget)
 
         self.setObjectName('TRAADRE Ground Station')
 
+    def shutdown_plugin(self):
+        self._widget.shutdown()
+
     def save_settings(self, plugin_settings, instance_settings):
         self._widget.save_settings(plugin_settings, instance_settings)
 